@@ -1,10 +1,14 @@
 import json
+import re
 from collections import defaultdict
 
+# 匹配形如 "1645年 闰五月" 的条目
+LEAP_MONTH_PATTERN = re.compile(r'(\d+)年\s*闰(\S+?)(?=，|\s|$)')
+
 
 def read_lunar_leap_months(file_path):
     with open(file_path, 'r', encoding='utf-8') as file:
-        lines = file.readlines()
+        text = file.read()
 
     lunar_leap_data = defaultdict(list)
     month_map = {
@@ -13,22 +17,10 @@ def read_lunar_leap_months(file_path):
         '冬月': 11, '腊月': 12
     }
 
-    for line in lines:
-        line = line.strip()
-        if line:
-            entries = line.split('，')
-            for entry in entries:
-                year_month = entry.split('年 闰')
-                year = int(year_month[0].strip())
-                leap_month = year_month[1].strip()
-                month_number = month_map[leap_month]
-                lunar_leap_data[month_number].append(year)
-
-    for month in range(1, 13):
-        if month not in lunar_leap_data:
-            lunar_leap_data[month] = []
-
-    sorted_lunar_leap_data = {k: sorted(v) for k, v in sorted(lunar_leap_data.items())}
+    for year, leap_month in LEAP_MONTH_PATTERN.findall(text):
+        lunar_leap_data[month_map[leap_month]].append(int(year))
+
+    sorted_lunar_leap_data = {month: sorted(lunar_leap_data.get(month, [])) for month in range(1, 13)}
 
     return sorted_lunar_leap_data
 
@@ -1,13 +1,19 @@
 import os
-from datetime import datetime, timedelta
-
-from dotenv import load_dotenv, set_key
+import shutil
+import tempfile
+from contextlib import contextmanager
+from datetime import date, datetime, timezone
+from functools import lru_cache
+from io import StringIO
+
+from dotenv import load_dotenv
+from dotenv.parser import parse_stream
 from google.auth.transport.requests import Request
 from google.oauth2.credentials import Credentials
 from google_auth_oauthlib.flow import InstalledAppFlow
 from googleapiclient.discovery import build
-from icalendar import Calendar, Event
-from lunarcalendar import Converter, DateNotExist, Lunar
+from icalendar import Calendar, Event, vDDDTypes, vText
+from lunarcalendar import Converter, Lunar
 
 # 加载环境变量
 load_dotenv()
@@ -15,15 +21,122 @@ load_dotenv()
 # 定义 OAuth2.0 范围，只读访问联系人
 SCOPES = ['https://www.googleapis.com/auth/contacts.readonly']
 
+# 用于构造任意月日（包括 2 月 29 日）的闰年
+REFERENCE_LEAP_YEAR = 2000
+
+# 待写入 .env 文件的数据
+PENDING_ENV = {}
+
+# 写入 ICS 文件时使用的缓冲区大小
+WRITE_BUFFER_SIZE = 1 << 20
+
+# ICS 日历结尾
+CALENDAR_END = b'END:VCALENDAR\r\n'
+
+# 事件标题和描述的格式化函数，按是否有起始年份（能否计算年龄或周年数）索引
+GREGORIAN_BIRTHDAY_FORMATS = (
+    ('{name}的生日🎂'.format, '今天是{preferred_name}的生日！'.format),
+    ('{name}的{age}岁生日🎂'.format, '今天是{preferred_name}的{age}岁生日！'.format),
+)
+LUNAR_BIRTHDAY_FORMATS = (
+    ('{name}的农历生日🎂'.format, '今天是{preferred_name}的农历生日！'.format),
+    ('{name}的{age}岁农历生日🎂'.format, '今天是{preferred_name}的{age}岁农历生日！'.format),
+)
+ANNIVERSARY_FORMATS = (
+    ('{name}周年纪念日'.format, '今天是{name}周年纪念日！'.format),
+    ('{name}{age}周年纪念日'.format, '今天是{name}{age}周年纪念日！'.format),
+)
+
+
+@contextmanager
+def open_for_replace(file_path, mode, new_file_mode=0o600, **kwargs):
+    """
+    打开同目录下的临时文件用于写入，写入成功后再替换目标文件，失败时删除临时文件
+    :param file_path: 目标文件路径
+    :param mode: 打开模式，如 'w' 或 'wb'
+    :param new_file_mode: 目标文件不存在时使用的权限，已存在时沿用原文件的权限
+    :param kwargs: 传给 open 的其他参数
+    :return: 临时文件对象
+    """
+    directory = os.path.dirname(os.path.abspath(file_path))
+    # mkstemp 创建的文件权限为 0600，不受 umask 影响
+    fd, tmp_file = tempfile.mkstemp(dir=directory, prefix=f'.{os.path.basename(file_path)}.', suffix='.tmp')
+    try:
+        with os.fdopen(fd, mode, **kwargs) as f:
+            yield f
+
+        if os.path.exists(file_path):
+            shutil.copymode(file_path, tmp_file)
+        else:
+            os.chmod(tmp_file, new_file_mode)
+        os.replace(tmp_file, file_path)
+    except BaseException:
+        if os.path.exists(tmp_file):
+            os.remove(tmp_file)
+        raise
+
 
 def save_to_env(key, value):
     """
-    保存数据到 .env 文件中
+    暂存要保存到 .env 文件中的数据，由 flush_env 统一写入
+    值为 None 时（例如授权流程没有返回刷新令牌）忽略，保留 .env 中原有的值
     :param key: 环境变量的名称
     :param value: 要保存的值
     """
+    if value is None:
+        print(f'{key} 为空，不保存到 .env 文件')
+        return
+    PENDING_ENV[key] = value
+
+
+def flush_env():
+    """
+    将暂存的数据一次性写入 .env 文件，保留文件中的其他内容
+    """
+    if not PENDING_ENV:
+        return
+
     env_file = os.getenv('ENV_PATH', '.env')
-    set_key(env_file, key, value)
+    source = ''
+    if os.path.exists(env_file):
+        with open(env_file, 'r', encoding='utf-8') as f:
+            source = f.read()
+
+    # 与 dotenv.set_key 相同，值统一使用单引号包裹
+    lines_out = {
+        key: "{}='{}'\n".format(key, value.replace('\\', '\\\\').replace("'", "\\'"))
+        for key, value in PENDING_ENV.items()
+    }
+
+    # 与 dotenv.set_key 相同，按 dotenv 的解析结果逐条改写，其余内容原样保留
+    # 同一个键出现多次时每一条都要改写，因为 dotenv 读取时以最后一次出现为准
+    chunks = []
+    seen = set()
+    for binding in parse_stream(StringIO(source)):
+        if binding.key in lines_out:
+            chunks.append(lines_out[binding.key])
+            seen.add(binding.key)
+        else:
+            chunks.append(binding.original.string)
+    if chunks and not chunks[-1].endswith('\n'):
+        chunks.append('\n')
+    chunks.extend(line for key, line in lines_out.items() if key not in seen)
+
+    # 先写入临时文件再替换，避免写入中断导致 .env 损坏，并保持原文件的权限
+    with open_for_replace(env_file, 'w', encoding='utf-8') as f:
+        f.write(''.join(chunks))
+
+    PENDING_ENV.clear()
+
+
+def save_access_token(creds):
+    """
+    暂存访问令牌及其过期时间，写入 .env 文件后供下次运行时直接使用
+    :param creds: 凭据对象
+    """
+    save_to_env('GOOGLE_ACCESS_TOKEN', creds.token)
+    # expiry 为不带时区的 UTC 时间
+    save_to_env('GOOGLE_TOKEN_EXPIRY', creds.expiry.isoformat())
 
 
 def get_credentials():
@@ -31,39 +144,63 @@ def get_credentials():
     获取 Google API 凭据
     :return: 凭据对象，用于后续 API 调用
     """
-    creds = None
     refresh_token = os.getenv('GOOGLE_REFRESH_TOKEN')
+    client_id = os.getenv('GOOGLE_CLIENT_ID')
+    client_secret = os.getenv('GOOGLE_CLIENT_SECRET')
+    token_uri = os.getenv('GOOGLE_TOKEN_URI')
 
     if refresh_token:
+        # 只有同时保存了过期时间，缓存的访问令牌才可信
+        access_token = os.getenv('GOOGLE_ACCESS_TOKEN')
+        token_expiry = os.getenv('GOOGLE_TOKEN_EXPIRY')
+        try:
+            token_expiry = datetime.fromisoformat(token_expiry) if access_token and token_expiry else None
+        except ValueError:
+            # 过期时间格式有误时视为没有缓存，走刷新流程
+            token_expiry = None
+        # google-auth 使用不带时区的 UTC 时间比较，带时区的值需先转换
+        if token_expiry and token_expiry.tzinfo:
+            token_expiry = token_expiry.astimezone(timezone.utc).replace(tzinfo=None)
+        if not token_expiry:
+            access_token = None
+
         # 使用现有的刷新令牌来获取凭据
         creds = Credentials(
-            None,
+            access_token,
             refresh_token=refresh_token,
-            token_uri=os.getenv('GOOGLE_TOKEN_URI'),
-            client_id=os.getenv('GOOGLE_CLIENT_ID'),
-            client_secret=os.getenv('GOOGLE_CLIENT_SECRET'),
-            scopes=SCOPES
+            token_uri=token_uri,
+            client_id=client_id,
+            client_secret=client_secret,
+            scopes=SCOPES,
+            expiry=token_expiry
         )
 
-        # 刷新访问令牌
-        creds.refresh(Request())
-
-    if not refresh_token or not creds or not creds.valid:
-        # 如果没有刷新令牌或者凭据无效，需要用户授权
-        flow = InstalledAppFlow.from_client_config({
-            'web': {
-                'client_id': os.getenv('GOOGLE_CLIENT_ID'),
-                'client_secret': os.getenv('GOOGLE_CLIENT_SECRET'),
-                'auth_uri': os.getenv('GOOGLE_AUTH_URI'),
-                'token_uri': os.getenv('GOOGLE_TOKEN_URI'),
-                'auth_provider_x509_cert_url': os.getenv('GOOGLE_AUTH_PROVIDER_X509_CERT_URL')
-            }
-        }, SCOPES)
-
-        creds = flow.run_local_server(port=8080)
+        # 缓存的访问令牌仍然有效时直接使用，省去一次刷新请求
+        if creds.valid:
+            return creds
 
-        # 保存刷新令牌到 .env 文件
-        save_to_env('GOOGLE_REFRESH_TOKEN', creds.refresh_token)
+        # 刷新访问令牌，成功则直接返回，无需构建授权流程
+        creds.refresh(Request())
+        if creds.valid:
+            save_access_token(creds)
+            return creds
+
+    # 如果没有刷新令牌或者凭据无效，需要用户授权
+    flow = InstalledAppFlow.from_client_config({
+        'web': {
+            'client_id': client_id,
+            'client_secret': client_secret,
+            'auth_uri': os.getenv('GOOGLE_AUTH_URI'),
+            'token_uri': token_uri,
+            'auth_provider_x509_cert_url': os.getenv('GOOGLE_AUTH_PROVIDER_X509_CERT_URL')
+        }
+    }, SCOPES)
+
+    creds = flow.run_local_server(port=8080)
+
+    # 暂存刷新令牌和访问令牌，稍后写入 .env 文件
+    save_to_env('GOOGLE_REFRESH_TOKEN', creds.refresh_token)
+    save_access_token(creds)
 
     return creds
 
@@ -84,7 +221,7 @@ def has_birthday_or_event(contact):
     :param contact: 联系人信息字典
     :return: 如果联系人有生日或事件，返回 True，否则返回 False
     """
-    return ('birthdays' in contact and contact['birthdays']) or ('events' in contact and contact['events'])
+    return bool(contact.get('birthdays') or contact.get('events'))
 
 
 def get_connections(service):
@@ -93,236 +230,284 @@ def get_connections(service):
     :param service: Google API 服务对象
     :return: 包含生日或事件的联系人列表
     """
-    results = service.people().connections().list(
+    connections = []
+    request = service.people().connections().list(
         resourceName='people/me',
         pageSize=1000,
-        personFields='names,nicknames,birthdays,events'
-    ).execute()
-    return [conn for conn in results.get('connections', []) if has_birthday_or_event(conn)]
+        personFields='names,nicknames,birthdays,events',
+        # 只返回用到的字段，减小响应体积
+        fields='connections(names/displayName,nicknames/value,birthdays/date,events/type,events/date),nextPageToken'
+    )
+
+    # 按 nextPageToken 逐页获取，避免超过 1000 个联系人时数据被截断
+    while request is not None:
+        results = request.execute()
+        connections.extend(conn for conn in results.get('connections', []) if has_birthday_or_event(conn))
+        request = service.people().connections().list_next(request, results)
+
+    return connections
 
 
-def add_gregorian_birthday_event(name, nickname, birth_date, year, calendar, birth_year):
+def create_event_template(categories, dtstamp):
     """
-    添加公历生日事件到日历
+    创建事件模板，包含同类事件共有的属性
+    :param categories: 事件类别
+    :param dtstamp: 事件时间戳
+    :return: 事件对象，新事件以其为基础复制
+    """
+    template = Event()
+    template.add('status', 'CONFIRMED')
+    template.add('categories', categories)
+    template.add('dtstamp', dtstamp)
+    template.add('last-modified', dtstamp)
+    return template
+
+
+def replace_year(base_date, year):
+    """
+    将日期替换到指定年份，2 月 29 日在平年取 2 月 28 日
+    :param base_date: 原日期（date 对象）
+    :param year: 目标年份
+    :return: 目标年份中的日期（date 对象）
+    """
+    try:
+        return base_date.replace(year=year)
+    except ValueError:
+        return base_date.replace(year=year, day=28)
+
+
+def build_event(template, uid, summary, description, start_date):
+    """
+    基于模板生成一个全天事件
+    :param template: 事件模板
+    :param uid: 事件 UID
+    :param summary: 事件标题
+    :param description: 事件描述
+    :param start_date: 事件日期（date 对象）
+    :return: 事件的 ICS 字节串
+    """
+    event = Event(template)
+
+    # 添加属性，直接赋值已包装的值，跳过 Event.add 的类型推断
+    event['uid'] = uid
+    event['summary'] = vText(summary)
+    event['dtstart'] = vDDDTypes(start_date)
+    event['dtend'] = vDDDTypes(date.fromordinal(start_date.toordinal() + 1))
+    event['description'] = vText(description)
+
+    return event.to_ical()
+
+
+def add_gregorian_birthday_event(name, preferred_name, start_date, birth_year, formats, template, uid_prefix):
+    """
+    生成公历生日事件
     :param name: 联系人名称
-    :param nickname 联系人昵称
-    :param birth_date: 出生日期（datetime 对象）
-    :param year: 要添加事件的年份
-    :param calendar: 日历对象
+    :param preferred_name: 描述中使用的称呼，优先为昵称
+    :param start_date: 当年生日日期（date 对象）
     :param birth_year: 出生年份
+    :param formats: 标题和描述的格式化函数，取自 GREGORIAN_BIRTHDAY_FORMATS
+    :param template: 事件模板
+    :param uid_prefix: 事件 UID 前缀
+    :return: 事件的 ICS 字节串
     """
-    event = Event()
+    age = start_date.year - birth_year if birth_year else None
+    format_summary, format_description = formats
+    summary = format_summary(name=name, age=age)
+    description = format_description(preferred_name=preferred_name, age=age)
+    uid = uid_prefix + start_date.isoformat() + '-gregorian-birthday@finn'
 
-    age = year - birth_year if birth_year else None
-    if birth_year:
-        summary = f'{name}的{age}岁生日🎂'
-        description = f'今天是{get_preferred_nickname(name, nickname)}的{age}岁生日！'
-    else:
-        summary = f'{name}的生日🎂'
-        description = f'今天是{get_preferred_nickname(name, nickname)}的生日！'
+    return build_event(template, uid, summary, description, start_date)
 
-    now = datetime.now()
 
-    # 添加属性
-    event['uid'] = f'{name}-{year}-{birth_date.month:02d}-{birth_date.day:02d}-gregorian-birthday@finn'
-    event.add('summary', summary)
-    event.add('dtstart', datetime(year, birth_date.month, birth_date.day).date())
-    event.add('dtend', (datetime(year, birth_date.month, birth_date.day) + timedelta(days=1)).date())
-    event.add('description', description)
-    event.add('status', 'CONFIRMED')
-    event.add('categories', 'BIRTHDAY')
-    event.add('dtstamp', now)
-    event.add('last-modified', now)
+@lru_cache(maxsize=None)
+def lunar_month_days(year, month):
+    """
+    获取农历某年某月（非闰月）的天数
+    :param year: 农历年份
+    :param month: 农历月份
+    :return: 该月天数，29 或 30
+    """
+    # lunarcalendar 的月份表：第 13-16 位为闰月月份，第 12 位起依次为各月（含闰月）是否为大月
+    month_info = Converter.lunar_month_days[year - Converter.lunar_month_days[0]]
+    leap_month = (month_info >> 13) & 0xf
+    index = month - 1 if leap_month == 0 or month <= leap_month else month
+    return 30 if (month_info >> (12 - index)) & 1 else 29
 
-    # 将事件添加到日历中
-    calendar.add_component(event)
 
+@lru_cache(maxsize=None)
+def lunar_to_solar(year, month, day):
+    """
+    将农历日期转换为公历日期，结果按 (年, 月, 日) 缓存
+    :param year: 农历年份
+    :param month: 农历月份
+    :param day: 农历日期，超出当月天数时取当月最后一天
+    :return: 公历日期（date 对象），无法转换时返回 None
+    """
+    # 月份表第 0 项为起始年份，其后依次为各年数据，超出范围的年份无法转换
+    first_year = Converter.lunar_month_days[0] + 1
+    last_year = Converter.lunar_month_days[0] + len(Converter.lunar_month_days) - 1
+    if not first_year <= year <= last_year or not 1 <= month <= 12 or day < 1:
+        return None
 
-def add_lunar_birthday_event(name, nickname, lunar_date, year, calendar):
+    # 小月没有三十，直接按当月天数截断，无需逐日试探
+    day = min(day, lunar_month_days(year, month))
+    solar = Converter.Lunar2Solar(Lunar(year, month, day, check=False))
+    return date(solar.year, solar.month, solar.day)
+
+
+def add_lunar_birthday_event(name, preferred_name, lunar_date, year, formats, template, uid_prefix):
     """
-    添加农历生日事件到日历
+    生成农历生日事件
     :param name: 联系人名称
-    :param nickname 联系人昵称
+    :param preferred_name: 描述中使用的称呼，优先为昵称
     :param lunar_date: 农历日期字典，包含月份、日期
     :param year: 要添加事件的年份
-    :param calendar: 日历对象
-    """
-    event = Event()
-
-    # 默认将 solar_date 初始化为 None
-    solar_date = None
-
-    if 'year' in lunar_date:
-        # 有年份信息的农历日期，转换为公历日期并计算年龄
-        while True:
-            try:
-                lunar = Lunar(year, lunar_date['month'], lunar_date['day'])
-                solar = Converter.Lunar2Solar(lunar)
-                break
-            except DateNotExist:
-                # 如果日期不存在，将农历日期提前一天
-                lunar_date['day'] -= 1
-                if lunar_date['day'] < 1:
-                    raise ValueError(f'Lunar date adjustment failed for {name}. Please check the data.')
-
-        solar_date = datetime(solar.year, solar.month, solar.day)
-        # 这里原本是 age = solar.year- lunar_date['year']
-        age = year - lunar_date['year']
-
-        summary = f'{name}的{age}岁农历生日🎂'
-        description = f'今天是{get_preferred_nickname(name, nickname)}的{age}岁农历生日！'
-
-    else:
-        # 没有年份信息的农历日期，找到相应年份的农历日期并计算
-        while True:
-            try:
-                lunar = Lunar(year, lunar_date['month'], lunar_date['day'])
-                solar = Converter.Lunar2Solar(lunar)
-                break
-            except DateNotExist:
-                # 如果日期不存在，将农历日期提前一天
-                lunar_date['day'] -= 1
-                if lunar_date['day'] < 1:
-                    raise ValueError(f'Lunar date adjustment failed for {name}. Please check the data.')
-
-        solar_date = datetime(solar.year, solar.month, solar.day)
-        summary = f'{name}的农历生日🎂'
-        description = f'今天是{get_preferred_nickname(name, nickname)}的农历生日！'
-
-    # 确保 solar_date 已经被正确处理
-    if solar_date:
-        now = datetime.now()
-
-        # 添加属性
-        event['uid'] = f'{name}-{solar_date.year}-{solar_date.month:02d}-{solar_date.day:02d}-lunar-birthday@finn'
-        event.add('summary', summary)
-        event.add('dtstart', solar_date.date())
-        event.add('dtend', (solar_date + timedelta(days=1)).date())
-        event.add('description', description)
-        event.add('status', 'CONFIRMED')
-        event.add('categories', 'BIRTHDAY')
-        event.add('dtstamp', now)
-        event.add('last-modified', now)
-
-        # 将事件添加到日历中
-        calendar.add_component(event)
-    else:
-        raise ValueError(f'Failed to calculate solar date for {name}\'s lunar birthday.')
-
-
-def add_anniversary_event(name, event_date, year, calendar, anniversary_year):
-    """
-    添加周年纪念日事件到日历
-    :param name: 事件名称
-    :param event_date: 事件日期（字典，包含月份、日期）
-    :param year: 要添加事件的年份
-    :param calendar: 日历对象
-    :param anniversary_year: 纪念开始年份
+    :param formats: 标题和描述的格式化函数，取自 LUNAR_BIRTHDAY_FORMATS
+    :param template: 事件模板
+    :param uid_prefix: 事件 UID 前缀
+    :return: 事件的 ICS 字节串
     """
-    event = Event()
-    age = year - anniversary_year if anniversary_year else None
-    anniv_date = datetime(year, event_date['month'], event_date['day'])
+    # 将农历日期转换为当年的公历日期，有无年份信息都只需转换一次
+    solar_date = lunar_to_solar(year, lunar_date['month'], lunar_date['day'])
+    if not solar_date:
+        raise ValueError(f'Lunar date adjustment failed for {name}. Please check the data.')
+
+    # 有年份信息的农历日期，计算年龄
+    age = year - lunar_date['year'] if 'year' in lunar_date else None
+    format_summary, format_description = formats
+    summary = format_summary(name=name, age=age)
+    description = format_description(preferred_name=preferred_name, age=age)
 
-    event_name = name.strip()
+    uid = uid_prefix + solar_date.isoformat() + '-lunar-birthday@finn'
 
-    if anniversary_year:
-        summary = f'{event_name}{age}周年纪念日'
-        description = f'今天是{event_name}{age}周年纪念日！'
-    else:
-        summary = f'{event_name}周年纪念日'
-        description = f'今天是{event_name}周年纪念日！'
+    return build_event(template, uid, summary, description, solar_date)
 
-    now = datetime.now()
 
-    # 添加属性
-    event['uid'] = f'{event_name}-{year}-{event_date["month"]:02d}-{event_date["day"]:02d}-anniversary@finn'
-    event.add('summary', summary)
-    event.add('dtstart', anniv_date.date())
-    event.add('dtend', (anniv_date + timedelta(days=1)).date())
-    event.add('description', description)
-    event.add('status', 'CONFIRMED')
-    event.add('categories', 'ANNIVERSARY')
-    event.add('dtstamp', now)
-    event.add('last-modified', now)
+def add_anniversary_event(event_name, start_date, anniversary_year, formats, template, uid_prefix):
+    """
+    生成周年纪念日事件
+    :param event_name: 事件名称
+    :param start_date: 当年纪念日日期（date 对象）
+    :param anniversary_year: 纪念开始年份
+    :param formats: 标题和描述的格式化函数，取自 ANNIVERSARY_FORMATS
+    :param template: 事件模板
+    :param uid_prefix: 事件 UID 前缀
+    :return: 事件的 ICS 字节串
+    """
+    age = start_date.year - anniversary_year if anniversary_year else None
+    format_summary, format_description = formats
+    summary = format_summary(name=event_name, age=age)
+    description = format_description(name=event_name, age=age)
+    uid = uid_prefix + start_date.isoformat() + '-anniversary@finn'
 
-    # 将事件添加到日历中
-    calendar.add_component(event)
+    return build_event(template, uid, summary, description, start_date)
 
 
-def create_calendar(data, current_year, years_to_create):
+def iter_calendar(data, current_year, years_to_create):
     """
-    创建包含生日和事件的日历
+    逐个生成日历的 ICS 片段，不在内存中保存完整日历
     :param data: 联系人数据列表
     :param current_year: 当前年份
     :param years_to_create: 要生成的年份数量
-    :return: 日历对象，包含所有生日和事件
+    :return: 依次产出日历头部、各事件和日历结尾的字节串
     """
     cal = Calendar()
     cal.add('prodid', '-//Google Inc//Google Calendar 70.9054//ZH_CN')
     cal.add('version', '2.0')
     cal.add('x-wr-calname', '生日快乐')
 
+    # 先产出日历头部，事件全部产出后再补上结尾
+    header = cal.to_ical()
+    if not header.endswith(CALENDAR_END):
+        raise ValueError('Unexpected calendar serialization: missing END:VCALENDAR.')
+    yield header[:-len(CALENDAR_END)]
+
+    # 所有联系人共用同一组年份
+    years = range(current_year, current_year + years_to_create)
+
+    # 所有事件共用同一个 UTC 时间戳（RFC 5545 要求 DTSTAMP 为 UTC），固定不变的属性放入模板中
+    dtstamp = datetime.now(timezone.utc)
+    birthday_template = create_event_template('BIRTHDAY', dtstamp)
+    anniversary_template = create_event_template('ANNIVERSARY', dtstamp)
+
     for person in data:
         name = person['names'][0]['displayName']
+        # UID 前缀在各年份间不变，每个联系人只拼接一次
+        uid_prefix = f'{name}-'
 
-        if 'nicknames' in person:
-            nickname = person['nicknames'][0]['value']
-        else:
-            nickname = None
-
-        if 'birthdays' in person:
-            birthday_info = person['birthdays'][0]['date']
-            birth_date = datetime(
-                birthday_info['year'] if 'year' in birthday_info else current_year,
-                birthday_info['month'],
-                birthday_info['day']
-            )
+        nicknames = person.get('nicknames')
+        nickname = nicknames[0]['value'] if nicknames else None
+        preferred_name = get_preferred_nickname(name, nickname)
+
+        birthdays = person.get('birthdays')
+        if birthdays:
+            birthday_info = birthdays[0]['date']
+            birth_date = date(REFERENCE_LEAP_YEAR, birthday_info['month'], birthday_info['day'])
             birth_year = birthday_info.get('year')
-            for year in range(current_year, current_year + years_to_create):
-                add_gregorian_birthday_event(name, nickname, birth_date, year, cal, birth_year)
-
-        if 'events' in person:
-            for event in person['events']:
-                event_description = event.get('type', '').lower()
-                if '农历生日' in event_description:
-                    lunar_date = event['date']
-                    for year in range(current_year, current_year + years_to_create):
-                        add_lunar_birthday_event(name, nickname, lunar_date, year, cal)
-                elif '周年纪念日' in event_description:
-                    event_name = event_description.split('#')[0]
-                    event_date = event['date']
-                    anniversary_year = event_date.get('year')
-                    for year in range(current_year, current_year + years_to_create):
-                        add_anniversary_event(event_name, event_date, year, cal, anniversary_year)
-
-    return cal
-
-
-def save_calendar(calendar, file_path):
-    """
-    保存日历到 ICS 文件
-    :param calendar: 日历对象
+            formats = GREGORIAN_BIRTHDAY_FORMATS[bool(birth_year)]
+            for year in years:
+                start_date = replace_year(birth_date, year)
+                yield add_gregorian_birthday_event(name, preferred_name, start_date, birth_year, formats, birthday_template, uid_prefix)
+
+        for event in person.get('events', []):
+            # 事件类型在各年份间不变，每个事件只解析一次
+            event_description = event.get('type', '').lower()
+            if '农历生日' in event_description:
+                lunar_date = event['date']
+                formats = LUNAR_BIRTHDAY_FORMATS['year' in lunar_date]
+                for year in years:
+                    yield add_lunar_birthday_event(name, preferred_name, lunar_date, year, formats, birthday_template, uid_prefix)
+            elif '周年纪念日' in event_description:
+                event_name = event_description.split('#')[0].strip()
+                event_date = event['date']
+                anniversary_date = date(REFERENCE_LEAP_YEAR, event_date['month'], event_date['day'])
+                anniversary_year = event_date.get('year')
+                anniv_uid_prefix = f'{event_name}-'
+                formats = ANNIVERSARY_FORMATS[bool(anniversary_year)]
+                for year in years:
+                    start_date = replace_year(anniversary_date, year)
+                    yield add_anniversary_event(event_name, start_date, anniversary_year, formats, anniversary_template, anniv_uid_prefix)
+
+    yield CALENDAR_END
+
+
+def save_calendar(data, current_year, years_to_create, file_path):
+    """
+    生成日历并保存到 ICS 文件
+    :param data: 联系人数据列表
+    :param current_year: 当前年份
+    :param years_to_create: 要生成的年份数量
     :param file_path: 要保存的文件路径
     """
-    with open(file_path, 'wb') as f:
-        f.write(calendar.to_ical())
+    # 写入临时文件，全部生成成功后再替换，生成失败时保留原有的日历文件
+    # 日历文件需要发布出去，新建时使用常规的 0644 权限
+    with open_for_replace(file_path, 'wb', new_file_mode=0o644, buffering=WRITE_BUFFER_SIZE) as f:
+        f.writelines(iter_calendar(data, current_year, years_to_create))
 
 
 def main():
     """
     主函数，获取并保存联系人生日和事件
     """
-    creds = get_credentials()
-    service = build('people', 'v1', credentials=creds)
-    connections = get_connections(service)
-
-    current_year = datetime.now().year
-    years_to_create = 5
-    calendar = create_calendar(connections, current_year, years_to_create)
-
-    save_calendar(calendar, './birthdays.ics')
-
-    print('日历文件已保存至 ./birthdays.ics')
+    try:
+        creds = get_credentials()
+        service = build('people', 'v1', credentials=creds)
+        connections = get_connections(service)
+
+        current_year = datetime.now().year
+        years_to_create = 5
+        save_calendar(connections, current_year, years_to_create, './birthdays.ics')
+
+        print('日历文件已保存至 ./birthdays.ics')
+    except BaseException:
+        # 即使后续步骤失败，也要保存已获取的令牌；此时保存失败只打印错误，以免掩盖原始异常
+        try:
+            flush_env()
+        except Exception as e:
+            print(f'保存 .env 文件失败：{e}')
+        raise
+
+    flush_env()
 
 
 if __name__ == '__main__':